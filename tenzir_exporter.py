@@ -1,16 +1,146 @@
 # Reviewed October 02, 2024
 
-from prometheus_client import Info, Gauge, CollectorRegistry, push_to_gateway
-from flask import Flask, request
+from prometheus_client import Info, Gauge, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST
+from flask import Flask, request, Response
+import io
 import json
-import re
 import sys
 from loguru import logger
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Bodies above this size are streamed record by record through ijson
+# (when installed) so neither the raw bytes nor the whole batch of
+# Python objects is ever held at once
+_STREAM_THRESHOLD = 1 << 20
+
+# What a bad payload raises while parsing: ValueError covers
+# JSONDecodeError and UnicodeDecodeError, ijson has its own hierarchy
+if ijson is not None:
+    _PARSE_ERRORS = (ValueError, ijson.JSONError)
+else:
+    _PARSE_ERRORS = (ValueError,)
+
+_DECODER = json.JSONDecoder()
+
+# The two possible response bodies, prebuilt once
+_FETCH_OK = b'{"error": 0}'
+_FETCH_ERROR = b'{"error": 1}'
+
+
+def _stream_records(stream):
+    # multiple_values accepts Tenzir's concatenated root objects as-is
+    return ijson.items(stream, '', multiple_values = True)
+
+def _fast_set(gauge, value):
+    """
+    Write a Gauge's underlying value directly, skipping the wrapper frame
+    and validation in Gauge.set. Tied to prometheus_client internals
+    (the _value MutexValue attribute).
+    """
+    gauge._value.set(float(value))
+
+
+# Tenzir durations repeat heavily ("0ns" above all), so parsed values are
+# memoized; the cache is dropped wholesale once it grows past this bound
+_DUR_CACHE = {}
+_DUR_CACHE_MAX = 256
+
+
+def _dur(value):
+    """
+    Parse a Tenzir duration string like "1.5ms" into its numeric part,
+    dropping the unit suffix with a single C-level scan.
+    """
+    result = _DUR_CACHE.get(value)
+    if result is None:
+        result = float(value.rstrip('abcdefghijklmnopqrstuvwxyz'))
+        if len(_DUR_CACHE) >= _DUR_CACHE_MAX:
+            _DUR_CACHE.clear()
+        _DUR_CACHE[value] = result
+    return result
+
+
+def _iter_records(payload):
+    """
+    Yield each JSON object from a payload of concatenated objects,
+    as posted by "write json --compact-output".
+    """
+    if ijson is not None and len(payload) > _STREAM_THRESHOLD:
+        yield from _stream_records(io.BytesIO(payload))
+        return
+    if orjson is not None:
+        # "write json --compact-output" delimits objects with newlines; raw
+        # \r\n bytes cannot occur inside JSON strings, so dropping them
+        # before the splice is safe and leaves the objects adjacent
+        payload = payload.translate(None, delete = b'\r\n')
+        yield from orjson.loads(b'[' + payload.replace(b'}{', b'},{') + b']')
+        return
+    # Stdlib fallback: walk the buffer with raw_decode instead of repairing
+    # it into one big array, so no second full pass or intermediate string
+    text = payload.decode('utf-8')
+    idx = 0
+    end = len(text)
+    while idx < end:
+        obj, idx = _DECODER.raw_decode(text, idx)
+        yield obj
+        while idx < end and text[idx].isspace():
+            idx += 1
+
 # Logger initialization
 logger.remove()
 logger.add(sys.stdout, level="DEBUG", format="{time:YYYY-MM-DD HH:mm:ss} - {level} - {message}")
 
+# (attribute/metric name, documentation, label names)
+_GAUGE_SPECS = (
+    # Memory metrics
+    ("tenzir_memory_total_bytes", "Memory total bytes", ()),
+    ("tenzir_memory_used_bytes", "Memory used bytes", ()),
+    ("tenzir_memory_free_bytes", "Memory free bytes", ()),
+    # CPU metrics
+    ("tenzir_loadavg_1m", "Load average 1m", ()),
+    ("tenzir_loadavg_5m", "Load average 5m", ()),
+    ("tenzir_loadavg_15m", "Load average 15m", ()),
+    # Process metrics
+    ("tenzir_swap_space_usage", "Swap space usage", ()),
+    ("tenzir_open_fds", "Open FDS", ()),
+    ("tenzir_current_memory_usage", "Current memory usage", ()),
+    ("tenzir_peak_memory_usage", "Peak memory usage", ()),
+    # Disk metrics
+    ("tenzir_disk_total_bytes", "Disk total bytes", ()),
+    ("tenzir_disk_used_bytes", "Disk used bytes", ()),
+    ("tenzir_disk_free_bytes", "Disk free bytes", ()),
+    # Operator metrics
+    ("tenzir_operator_run", "The number of the run, starting at 1 for the first run.", ("pipeline_id",)),
+    ("tenzir_operator_duration", "Operator duration", ("pipeline_id",)),
+    ("tenzir_operator_starting_duration", "Operator starting duration", ("pipeline_id",)),
+    ("tenzir_operator_processing_duration", "Operator processing duration", ("pipeline_id",)),
+    ("tenzir_operator_scheduled_duration", "Operator scheduled duration", ("pipeline_id",)),
+    ("tenzir_operator_running_duration", "Operator running duration", ("pipeline_id",)),
+    ("tenzir_operator_paused_duration", "Operator paused duration", ("pipeline_id",)),
+    ("tenzir_operator_input_elements", "Operator input elements", ("pipeline_id", "unit")),
+    ("tenzir_operator_output_elements", "Operator output elements", ("pipeline_id", "unit")),
+    ("tenzir_operator_input_bytes", "Operator input approximate bytes", ("pipeline_id", "unit")),
+    ("tenzir_operator_output_bytes", "Operator output approximate bytes", ("pipeline_id", "unit")),
+    # Rebuild metrics
+    ("tenzir_rebuild_partitions", "The number of partitions currently being rebuilt.", ()),
+    ("tenzir_rebuild_queued_partitions", "The number of partitions currently queued for rebuilding.", ()),
+)
+
+_INFO_SPECS = (
+    ("tenzir_operator_input_unit", "Pipeline input unit", ("pipeline_id",)),
+    ("tenzir_operator_output_unit", "Pipeline output unit", ("pipeline_id",)),
+    ("tenzir_operator_pipeline_id", "Pipeline ID", ()),
+)
+
 
 class AppMetrics:
     """
@@ -18,148 +148,178 @@ class AppMetrics:
     application metrics into Prometheus metrics.
     """
 
+    # Fixed-offset slots instead of a per-instance __dict__; fetch reads
+    # these attributes dozens of times per record. Metric slots come from
+    # the spec tables so they cannot drift out of sync.
+    __slots__ = (
+        'registry',
+        '_child_cache',
+        '_pipe_cache',
+        '_last_pid',
+        '_last_values',
+        '_dispatch',
+    ) + tuple(name for name, _, _ in _GAUGE_SPECS + _INFO_SPECS)
+
     def __init__(self):
         self.registry = CollectorRegistry()
+        # Bound .labels() children keyed by (metric id, label values); every
+        # .labels() call is a locked dict lookup inside prometheus_client,
+        # so reuse the child once it exists
+        self._child_cache = {}
+        # Tuples of the single-label operator children per pipeline_id; one
+        # cache hit covers all of them for a record
+        self._pipe_cache = {}
+        self._last_pid = None
+        # Shadow of last-written values for slow-changing metrics, so equal
+        # writes skip the metric lock entirely
+        self._last_values = {}
+
+        for name, documentation, labelnames in _GAUGE_SPECS:
+            setattr(self, name, Gauge(name, documentation, labelnames, registry = self.registry))
+        for name, documentation, labelnames in _INFO_SPECS:
+            setattr(self, name, Info(name, documentation, labelnames, registry = self.registry))
+
+        # Each record type is recognized by a key only it carries; first hit
+        # wins, memory records are the keyless fallback
+        self._dispatch = {
+            "pipeline_id": self._handle_operator,
+            "loadavg_1m": self._handle_cpu,
+            "swap_space_usage": self._handle_process,
+            "path": self._handle_disk,
+            "partitions": self._handle_rebuild,
+        }
+
+    def _lbl(self, metric, *label_vals):
+        key = (id(metric),) + label_vals
+        child = self._child_cache.get(key)
+        if child is None:
+            child = metric.labels(*label_vals)
+            self._child_cache[key] = child
+        return child
 
-        # Memory metrics
-        self.tenzir_memory_total_bytes = Gauge("tenzir_memory_total_bytes", "Memory total bytes", registry = self.registry)
-        self.tenzir_memory_used_bytes = Gauge("tenzir_memory_used_bytes", "Memory used bytes", registry = self.registry)
-        self.tenzir_memory_free_bytes = Gauge("tenzir_memory_free_bytes", "Memory free bytes", registry = self.registry)
-        # CPU metrics
-        self.tenzir_loadavg_1m = Gauge("tenzir_loadavg_1m", "Load average 1m", registry = self.registry)
-        self.tenzir_loadavg_5m = Gauge("tenzir_loadavg_5m", "Load average 5m", registry = self.registry)
-        self.tenzir_loadavg_15m = Gauge("tenzir_loadavg_15m", "Load average 15m", registry = self.registry)
-        # Process metrics
-        self.tenzir_swap_space_usage = Gauge("tenzir_swap_space_usage", "Swap space usage", registry = self.registry)
-        self.tenzir_open_fds = Gauge("tenzir_open_fds", "Open FDS", registry = self.registry)
-        self.tenzir_current_memory_usage = Gauge("tenzir_current_memory_usage", "Current memory usage", registry = self.registry)
-        self.tenzir_peak_memory_usage = Gauge("tenzir_peak_memory_usage", "Peak memory usage", registry = self.registry)
-        # Disk metrics
-        self.tenzir_disk_total_bytes = Gauge("tenzir_disk_total_bytes", "Disk total bytes", registry = self.registry)
-        self.tenzir_disk_used_bytes = Gauge("tenzir_disk_used_bytes", "Disk used bytes", registry = self.registry)
-        self.tenzir_disk_free_bytes = Gauge("tenzir_disk_free_bytes", "Disk free bytes", registry = self.registry)
-        # Operator metrics
-        self.tenzir_operator_run = Gauge("tenzir_operator_run",
-                                        "The number of the run, starting at 1 for the first run.",
-                                        ['pipeline_id'], registry = self.registry)
-        self.tenzir_operator_duration = Gauge("tenzir_operator_duration",
-                                                "Operator duration",
-                                                ['pipeline_id'], registry = self.registry)
-        self.tenzir_operator_starting_duration = Gauge("tenzir_operator_starting_duration",
-                                                        "Operator starting duration",
-                                                        ['pipeline_id'], registry = self.registry)
-        self.tenzir_operator_processing_duration = Gauge("tenzir_operator_processing_duration",
-                                                        "Operator processing duration",
-                                                        ['pipeline_id'], registry = self.registry)
-        self.tenzir_operator_scheduled_duration = Gauge("tenzir_operator_scheduled_duration",
-                                                        "Operator scheduled duration",
-                                                        ['pipeline_id'], registry = self.registry)
-        self.tenzir_operator_running_duration = Gauge("tenzir_operator_running_duration",
-                                                        "Operator running duration",
-                                                        ['pipeline_id'], registry = self.registry)
-        self.tenzir_operator_paused_duration = Gauge("tenzir_operator_paused_duration",
-                                                        "Operator paused duration",
-                                                        ['pipeline_id'], registry = self.registry)
-        self.tenzir_operator_input_elements = Gauge("tenzir_operator_input_elements",
-                                                        "Operator input elements",
-                                                        ['pipeline_id', 'unit'], registry = self.registry)
-        self.tenzir_operator_output_elements = Gauge("tenzir_operator_output_elements",
-                                                        "Operator output elements",
-                                                        ['pipeline_id', 'unit'], registry = self.registry)
-        self.tenzir_operator_input_bytes = Gauge("tenzir_operator_input_bytes",
-                                                        "Operator input approximate bytes",
-                                                        ['pipeline_id', 'unit'], registry = self.registry)
-        self.tenzir_operator_output_bytes = Gauge("tenzir_operator_output_bytes",
-                                                        "Operator output approximate bytes",
-                                                        ['pipeline_id', 'unit'], registry = self.registry)
-        self.tenzir_operator_input_unit = Info("tenzir_operator_input_unit",
-                                                        "Pipeline input unit",
-                                                        ['pipeline_id'], registry = self.registry)
-        self.tenzir_operator_output_unit = Info("tenzir_operator_output_unit",
-                                                        "Pipeline output unit",
-                                                        ['pipeline_id'], registry = self.registry)
-        self.tenzir_operator_pipeline_id = Info("tenzir_operator_pipeline_id",
-                                                        "Pipeline ID", registry = self.registry)
-        # Rebuild metrics
-        self.tenzir_rebuild_partitions = Gauge("tenzir_rebuild_partitions",
-                                               "The number of partitions currently being rebuilt.",
-                                               registry = self.registry)
-        self.tenzir_rebuild_queued_partitions = Gauge("tenzir_rebuild_queued_partitions",
-                                                      "The number of partitions currently queued for rebuilding.",
-                                                      registry = self.registry)
-        
+    def _pipe_setters(self, pid):
+        setters = self._pipe_cache.get(pid)
+        if setters is None:
+            # Bound raw-value setters (see _fast_set) plus the two Info
+            # writers, so the hot loop is one call per metric
+            setters = (
+                self.tenzir_operator_run.labels(pid)._value.set,
+                self.tenzir_operator_duration.labels(pid)._value.set,
+                self.tenzir_operator_starting_duration.labels(pid)._value.set,
+                self.tenzir_operator_processing_duration.labels(pid)._value.set,
+                self.tenzir_operator_scheduled_duration.labels(pid)._value.set,
+                self.tenzir_operator_running_duration.labels(pid)._value.set,
+                self.tenzir_operator_paused_duration.labels(pid)._value.set,
+                self.tenzir_operator_input_unit.labels(pid).info,
+                self.tenzir_operator_output_unit.labels(pid).info,
+            )
+            self._pipe_cache[pid] = setters
+        return setters
+
+    def _handle_operator(self, item):
+        pid = item["pipeline_id"]
+        inp = item["input"]
+        out = item["output"]
+        input_unit = inp["unit"]
+        output_unit = out["unit"]
+        (set_run, set_duration, set_starting, set_processing, set_scheduled,
+         set_running, set_paused, input_unit_info, output_unit_info) = self._pipe_setters(pid)
+        set_run(float(item["run"]))
+        set_duration(_dur(item["duration"]))
+        set_starting(_dur(item["starting_duration"]))
+        set_processing(_dur(item["processing_duration"]))
+        set_scheduled(_dur(item["scheduled_duration"]))
+        set_running(_dur(item["running_duration"]))
+        set_paused(_dur(item["paused_duration"]))
+        # The unit-labelled quartet stays on the generic child cache since
+        # its key is (pipeline_id, unit)
+        _fast_set(self._lbl(self.tenzir_operator_input_elements, pid, input_unit), inp["elements"])
+        _fast_set(self._lbl(self.tenzir_operator_output_elements, pid, output_unit), out["elements"])
+        _fast_set(self._lbl(self.tenzir_operator_input_bytes, pid, input_unit), inp["approx_bytes"])
+        _fast_set(self._lbl(self.tenzir_operator_output_bytes, pid, output_unit), out["approx_bytes"])
+        # Units practically never change for a pipeline; skip the Info
+        # rewrite (dict allocation plus lock) when they have not
+        if self._last_values.get(("input_unit", pid)) != input_unit:
+            input_unit_info({"tenzir_operator_input_unit": input_unit})
+            self._last_values[("input_unit", pid)] = input_unit
+        if self._last_values.get(("output_unit", pid)) != output_unit:
+            output_unit_info({"tenzir_operator_output_unit": output_unit})
+            self._last_values[("output_unit", pid)] = output_unit
+        # Unlabelled Info, last write wins - only rewrite when the pipeline
+        # actually changes
+        if pid != self._last_pid:
+            self.tenzir_operator_pipeline_id.info({"pipeline_id": pid})
+            self._last_pid = pid
+
+    def _handle_cpu(self, item):
+        self.tenzir_loadavg_1m.set(item["loadavg_1m"])
+        self.tenzir_loadavg_5m.set(item["loadavg_5m"])
+        self.tenzir_loadavg_15m.set(item["loadavg_15m"])
+
+    def _handle_process(self, item):
+        self.tenzir_swap_space_usage.set(item["swap_space_usage"])
+        self.tenzir_open_fds.set(item["open_fds"])
+        self.tenzir_current_memory_usage.set(item["current_memory_usage"])
+        self.tenzir_peak_memory_usage.set(item["peak_memory_usage"])
+
+    def _set_if_changed(self, gauge, value):
+        key = id(gauge)
+        if self._last_values.get(key) == value:
+            return
+        gauge.set(value)
+        self._last_values[key] = value
+
+    def _handle_disk(self, item):
+        self._set_if_changed(self.tenzir_disk_total_bytes, item["total_bytes"])
+        self._set_if_changed(self.tenzir_disk_used_bytes, item["used_bytes"])
+        self._set_if_changed(self.tenzir_disk_free_bytes, item["free_bytes"])
+
+    def _handle_rebuild(self, item):
+        self.tenzir_rebuild_partitions.set(item["partitions"])
+        self.tenzir_rebuild_queued_partitions.set(item["queued_partitions"])
+
+    def _handle_memory(self, item):
+        self._set_if_changed(self.tenzir_memory_total_bytes, item["total_bytes"])
+        self._set_if_changed(self.tenzir_memory_used_bytes, item["used_bytes"])
+        self._set_if_changed(self.tenzir_memory_free_bytes, item["free_bytes"])
 
     def fetch(self):
-        logger.debug(f"# Request: {request}")
+        if ijson is not None and (request.content_length or 0) > _STREAM_THRESHOLD:
+            # Large bodies never get read whole: ijson parses straight off
+            # the WSGI input stream and yields one record at a time. The
+            # BufferedReader keeps ijson's zero-byte type probe away from
+            # werkzeug's LimitedStream, which treats it as a disconnect.
+            records = _stream_records(io.BufferedReader(request.stream))
+        else:
+            # cache=False skips Flask keeping a second reference to the body
+            payload = request.get_data(cache = False)
+            # lazy=True defers building the payload/item reprs until the
+            # DEBUG level is actually enabled
+            logger.opt(lazy = True).debug("# Data: {}", lambda: payload)
+            records = _iter_records(payload)
         try:
-            self.status_data = (request.data).decode('utf-8').splitlines()
-        except:
-            logger.error(f"# Cannot complete fetch() request")
-            return json.dumps({"error": 1})
-
-        logger.debug(f"# Data: {self.status_data}")
-        parsed_data = json.loads('[' + ''.join(self.status_data).replace('}{', '},{') + ']')
-        logger.debug(f"# Parsed data: {parsed_data}")
-        for item in parsed_data:
-            logger.debug(f"# Item in data: {item}")
-            if "schema" in item:
-                continue
-            if not(item.get("pipeline_id") is None):
-                reg = r'[a-z]'
-                duration = re.sub(reg, '', item["duration"])
-                starting_duration = re.sub(reg, '', item["starting_duration"])
-                processing_duration = re.sub(reg, '', item["processing_duration"])
-                scheduled_duration = re.sub(reg, '', item["scheduled_duration"])
-                running_duration = re.sub(reg, '', item["running_duration"])
-                paused_duration = re.sub(reg, '', item["paused_duration"])
-                self.tenzir_operator_run.labels(item["pipeline_id"]).set(duration)
-                self.tenzir_operator_duration.labels(item["pipeline_id"]).set(starting_duration)
-                self.tenzir_operator_starting_duration.labels(item["pipeline_id"]).set(starting_duration)
-                self.tenzir_operator_processing_duration.labels(item["pipeline_id"]).set(processing_duration)
-                self.tenzir_operator_scheduled_duration.labels(item["pipeline_id"]).set(scheduled_duration)
-                self.tenzir_operator_running_duration.labels(item["pipeline_id"]).set(running_duration)
-                self.tenzir_operator_paused_duration.labels(item["pipeline_id"]).set(paused_duration)
-                self.tenzir_operator_input_elements.labels(item["pipeline_id"], item["input"]["unit"]).set(item["input"]["elements"])
-                self.tenzir_operator_output_elements.labels(item["pipeline_id"], item["output"]["unit"]).set(item["output"]["elements"])
-                self.tenzir_operator_input_bytes.labels(item["pipeline_id"], item["input"]["unit"]).set(item["input"]["approx_bytes"])
-                self.tenzir_operator_output_bytes.labels(item["pipeline_id"], item["output"]["unit"]).set(item["output"]["approx_bytes"])
-                self.tenzir_operator_input_unit.labels(item["pipeline_id"]).info({"tenzir_operator_input_unit": item["input"]["unit"]})
-                self.tenzir_operator_output_unit.labels(item["pipeline_id"]).info({"tenzir_operator_input_unit": item["output"]["unit"]})
-                self.tenzir_operator_pipeline_id.info({"pipeline_id": item["pipeline_id"]})
-
-
-            elif not(item.get("loadavg_1m") is None):
-                self.tenzir_loadavg_1m.set(item["loadavg_1m"])
-                self.tenzir_loadavg_5m.set(item["loadavg_5m"])
-                self.tenzir_loadavg_15m.set(item["loadavg_15m"])
-
-            elif not(item.get("swap_space_usage") is None):
-                self.tenzir_swap_space_usage.set(item["swap_space_usage"])
-                self.tenzir_open_fds.set(item["open_fds"])
-                self.tenzir_current_memory_usage.set(item["current_memory_usage"])
-                self.tenzir_peak_memory_usage.set(item["peak_memory_usage"])
-
-            elif not(item.get("path") is None):
-                self.tenzir_disk_total_bytes.set(item["total_bytes"])
-                self.tenzir_disk_used_bytes.set(item["used_bytes"])
-                self.tenzir_disk_free_bytes.set(item["free_bytes"])
-
-            elif not(item.get("partitions") is None):
-                self.tenzir_rebuild_partitions.set(item["partitions"])
-                self.tenzir_rebuild_queued_partitions.set(item["queued_partitions"])
-
-            else:
-                self.tenzir_memory_total_bytes.set(item["total_bytes"])
-                self.tenzir_memory_used_bytes.set(item["used_bytes"])
-                self.tenzir_memory_free_bytes.set(item["free_bytes"])
-
-            push_to_gateway('s-msk-p-sem-tenzir01:9091', job = 'tenzir', registry = self.registry)
-        return json.dumps({"error": 0})
+            for item in records:
+                logger.opt(lazy = True).debug("# Item in data: {}", lambda: item)
+                if "schema" in item:
+                    continue
+                for key, handler in self._dispatch.items():
+                    if key in item:
+                        handler(item)
+                        break
+                else:
+                    self._handle_memory(item)
+        except _PARSE_ERRORS as error:
+            logger.error("# Cannot complete fetch() request: {}", error)
+            return _FETCH_ERROR
+        return _FETCH_OK
+
+    def metrics(self):
+        return Response(generate_latest(self.registry), mimetype = CONTENT_TYPE_LATEST)
 
 logger.debug(f"# Starting...")
 
 app_metrics = AppMetrics()
 
 app = Flask(__name__)
-app.debug = True
 app.add_url_rule("/", methods = ["POST"], view_func = app_metrics.fetch)
+app.add_url_rule("/metrics", methods = ["GET"], view_func = app_metrics.metrics)